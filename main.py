@@ -1,11 +1,23 @@
 import os
+import sys
+import time
+import asyncio
+import functools
 import datetime
 import json
+import math
+import hashlib
+import sqlite3
+import contextlib
+from abc import ABC, abstractmethod
 import logging
 import traceback
 import webbrowser
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import openai
 import anthropic
 import psutil
@@ -16,6 +28,11 @@ from rich.panel import Panel
 from rich.progress import Progress, SpinnerColumn, TextColumn
 from rich import print as rprint
 
+try:
+    import orjson
+except ImportError:  # fall back to the standard library serializer
+    orjson = None
+
 # Set up logging
 logging.basicConfig(filename='ai_process_report.log', level=logging.DEBUG,
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,11 +42,157 @@ load_dotenv()
 
 # Create a session for persistent HTTP connections
 http_session = requests.Session()
+http_session.headers.update({'User-Agent': 'ai-process-report', 'Connection': 'keep-alive'})
+# Analysis requests are informational, so retrying a POST on a gateway error is safe
+http_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    # read=0: a timed-out generation is never re-sent, only connection errors and gateway responses are retried
+    max_retries=Retry(total=3, read=0, backoff_factor=0.5, status_forcelist=[502, 503, 504],
+                      allowed_methods=frozenset({'GET', 'POST'}))
+)
+http_session.mount('http://', http_adapter)
+http_session.mount('https://', http_adapter)
 
 console = Console()
 
 PROCESS_LIMIT = int(os.getenv("PROCESS_LIMIT", 200))
 AI_PROVIDER = os.getenv('AI_PROVIDER', 'ollama').lower()
+CPU_SAMPLE_INTERVAL = float(os.getenv("CPU_SAMPLE_INTERVAL", 0.1))
+GATHER_WORKERS = int(os.getenv("GATHER_WORKERS", 16))
+AI_CACHE_FILE = os.getenv("AI_CACHE_FILE", ".ai_cache.sqlite")
+AI_CACHE_TTL_DAYS = float(os.getenv("AI_CACHE_TTL_DAYS", 30))
+ANALYSIS_CHUNK_SIZE = int(os.getenv("ANALYSIS_CHUNK_SIZE", 25))
+ANALYSIS_MAX_TOKENS = int(os.getenv("ANALYSIS_MAX_TOKENS", 1500))
+
+def _snapshot(proc, mem_total):
+    # Percentages are only ever shown to two decimals, so round once here
+    try:
+        return {
+            'pid': proc.info['pid'],
+            'name': proc.info['name'],
+            'exe': proc.info['exe'] or 'Unknown',
+            'status': proc.info['status'],
+            'username': proc.info['username'] or 'Unknown',
+            'cpu_percent': round(proc.cpu_percent(interval=None), 2),
+            'memory_percent': round(proc.memory_info().rss * 100.0 / mem_total, 2)
+        }
+    except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess) as e:
+        logging.warning(f"Skipping process due to: {e}")
+    except Exception as e:
+        logging.error(f"Unexpected error when getting process info: {e}")
+    return None
+
+def _gather_processes_psutil():
+    # psutil >= 6.0 caches Process objects between process_iter() calls; start fresh
+    psutil.process_iter.cache_clear()
+    # First pass primes each process's CPU timer (the first call always returns 0.0)
+    procs = []
+    for proc in psutil.process_iter(['pid', 'name', 'exe', 'status', 'username']):
+        try:
+            proc.cpu_percent(interval=None)
+            procs.append(proc)
+            if len(procs) >= PROCESS_LIMIT:
+                break
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess) as e:
+            logging.warning(f"Skipping process due to: {e}")
+        except Exception as e:
+            logging.error(f"Unexpected error when getting process info: {e}")
+
+    # One shared sampling window instead of a blocking interval per process
+    time.sleep(CPU_SAMPLE_INTERVAL)
+
+    # Total RAM does not change during the gather; read it once rather than per process
+    snapshot = functools.partial(_snapshot, mem_total=psutil.virtual_memory().total)
+    # psutil releases the GIL around its OS calls, so the reads overlap across threads
+    with ThreadPoolExecutor(max_workers=GATHER_WORKERS) as executor:
+        return [info for info in executor.map(snapshot, procs) if info is not None]
+
+# /proc/<pid>/stat state codes, named the same way psutil reports them
+PROC_STATUSES = {
+    'R': 'running', 'S': 'sleeping', 'D': 'disk-sleep', 'T': 'stopped', 't': 'tracing-stop',
+    'Z': 'zombie', 'X': 'dead', 'x': 'dead', 'K': 'wake-kill', 'W': 'waking', 'I': 'idle', 'P': 'parked'
+}
+
+def _read_proc_stat(pid):
+    """Return (name, state, cpu_ticks, rss_pages) from /proc/<pid>/stat."""
+    with open(f"/proc/{pid}/stat", 'rb') as f:
+        stat = f.read().decode('utf-8', 'replace')
+    # The name is wrapped in parentheses and may itself contain spaces or ')'
+    name_end = stat.rindex(')')
+    fields = stat[name_end + 2:].split()
+    return stat[stat.index('(') + 1:name_end], fields[0], int(fields[11]) + int(fields[12]), int(fields[21])
+
+def _read_proc_uid(pid):
+    with open(f"/proc/{pid}/status", 'rb') as f:
+        for line in f:
+            if line.startswith(b'Uid:'):
+                return int(line.split()[1])
+    return None
+
+def _gather_processes_linux():
+    """Read process details straight from /proc, skipping psutil's per-process machinery."""
+    import pwd
+
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    mem_total = psutil.virtual_memory().total
+    usernames = {}
+
+    def username(uid):
+        if uid not in usernames:
+            try:
+                usernames[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                usernames[uid] = str(uid)
+        return usernames[uid]
+
+    # First pass records identity fields and the starting CPU time of each process
+    samples = []
+    for pid in psutil.pids():
+        try:
+            name, _, cpu_ticks, _ = _read_proc_stat(pid)
+            if len(name) >= 15:
+                # The kernel truncates names to 15 chars; recover the full one from argv[0] like psutil does
+                with open(f"/proc/{pid}/cmdline", 'rb') as f:
+                    argv0 = os.path.basename(f.read().split(b'\0', 1)[0].decode('utf-8', 'replace'))
+                if argv0.startswith(name):
+                    name = argv0
+            uid = _read_proc_uid(pid)
+            try:
+                exe = os.readlink(f"/proc/{pid}/exe")
+            except OSError:
+                exe = None
+            samples.append((pid, name, exe, uid, cpu_ticks, time.monotonic()))
+            if len(samples) >= PROCESS_LIMIT:
+                break
+        except (FileNotFoundError, ProcessLookupError) as e:
+            logging.warning(f"Skipping process due to: {e}")
+        except Exception as e:
+            logging.error(f"Unexpected error when getting process info: {e}")
+
+    # One shared sampling window instead of a blocking interval per process
+    time.sleep(CPU_SAMPLE_INTERVAL)
+
+    processes = []
+    for pid, name, exe, uid, start_ticks, start_time in samples:
+        try:
+            _, state, cpu_ticks, rss_pages = _read_proc_stat(pid)
+            elapsed = time.monotonic() - start_time
+            processes.append({
+                'pid': pid,
+                'name': name,
+                'exe': exe or 'Unknown',
+                'status': PROC_STATUSES.get(state, state),
+                'username': username(uid) if uid is not None else 'Unknown',
+                'cpu_percent': round((cpu_ticks - start_ticks) / clock_ticks / elapsed * 100, 2) if elapsed > 0 else 0.0,
+                'memory_percent': round(rss_pages * page_size * 100 / mem_total, 2)
+            })
+        except (FileNotFoundError, ProcessLookupError) as e:
+            logging.warning(f"Skipping process due to: {e}")
+        except Exception as e:
+            logging.error(f"Unexpected error when getting process info: {e}")
+    return processes
 
 def get_processes():
     with Progress(
@@ -38,251 +201,308 @@ def get_processes():
         transient=True,
     ) as progress:
         task = progress.add_task("[cyan]Gathering processes...", total=None)
-        processes = []
-        for proc in psutil.process_iter(['pid', 'name', 'exe', 'status', 'username']):
-            try:
-                info = {
-                    'pid': proc.info['pid'],
-                    'name': proc.info['name'],
-                    'exe': proc.info['exe'] or 'Unknown',
-                    'status': proc.info['status'],
-                    'username': proc.info['username'] or 'Unknown',
-                    'cpu_percent': proc.cpu_percent(interval=0.1),
-                    'memory_percent': proc.memory_percent()
-                }
-                processes.append(info)
-                if len(processes) >= PROCESS_LIMIT:
-                    break
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess) as e:
-                logging.warning(f"Skipping process due to: {e}")
-            except Exception as e:
-                logging.error(f"Unexpected error when getting process info: {e}")
+        if sys.platform.startswith('linux'):
+            processes = _gather_processes_linux()
+        else:
+            processes = _gather_processes_psutil()
         progress.update(task, completed=100)
     return processes
 
-def save_processes_to_file(processes):
+def _json_dumps(obj):
+    """Compact JSON text, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'))
+
+def _json_loads(text):
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers can catch either
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+def save_processes_to_file(processes, pretty=False):
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M")
     filename = f"processes_{timestamp}.json"
-    with open(filename, 'w') as f:
-        json.dump(processes, f)
+    if orjson is not None:
+        data = orjson.dumps(processes, option=orjson.OPT_INDENT_2 if pretty else 0)
+    else:
+        data = json.dumps(processes, indent=2 if pretty else None,
+                          separators=None if pretty else (',', ':')).encode('utf-8')
+    with open(filename, 'wb') as f:
+        f.write(data)
     return filename
 
-def analyze_processes_anthropic(processes_file):
-    client = anthropic.Anthropic(
-        api_key=os.getenv("ANTHROPIC_API_KEY"),
-        default_headers={"anthropic-beta": "max-tokens-3-5-sonnet-2024-07-15"}
-    )
-    model = os.getenv("ANTHROPIC_MODEL", "claude-3-5-sonnet-20240620")
-    
-    with open(processes_file, 'r') as f:
-        processes = json.load(f)
-    
-    prompt = f"""Analyze the following list of Windows processes:
-
-{json.dumps(processes, indent=2)}
-
-For each process, provide a brief description of its typical function and assign a threat score from 0 (harmless) to 10 (highly suspicious). If you're uncertain about a process, state that clearly.
+def _prompt_payload(processes):
+    """Compact JSON with only the fields the model uses; main() has already deduplicated on (name, exe)."""
+    return _json_dumps([{'name': process['name'], 'exe': process['exe']} for process in processes])
+
+# Structured output shape shared by all providers: {process name: {description, threat_score}}
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "additionalProperties": {
+        "type": "object",
+        "properties": {
+            "description": {"type": "string"},
+            "threat_score": {"type": "number"}
+        },
+        "required": ["description", "threat_score"]
+    }
+}
+
+ANTHROPIC_ANALYSIS_TOOL = {
+    "name": "record_process_analysis",
+    "description": "Record the description and threat score for each analyzed process, keyed by process name.",
+    "input_schema": ANALYSIS_SCHEMA
+}
+
+# Shared by every provider; kept ahead of the process list so it forms a cacheable prefix
+PROMPT_INSTRUCTIONS = """You are a Windows security expert. Analyze the list of Windows processes that follows these instructions.
+
+For each process, provide a brief description of its typical function and assign a threat score from 0 (harmless) to 10 (highly suspicious). Consider the process name and path in your analysis. If the same name appears with more than one path, give a single verdict that reflects the most suspicious path and mention that path in the description. If you're uncertain about a process, state that clearly.
 
-Format your response as follows for each process:
-Process Name: [name]
-Description: [brief description]
-Threat Score: [score]
-
-Do not include any other text or formatting."""
-
-    with console.status(f"[bold green]Analyzing processes with Anthropic ({model})..."):
-        try:
-            response = client.messages.create(
-                model=model,
-                max_tokens=4000,
-                temperature=0,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            
-            logging.debug(f"Anthropic response tokens: input={response.usage.input_tokens}, output={response.usage.output_tokens}")
-            
-            # Access the content of the response
-            content = response.content
-            
-            # If content is a list of TextBlock objects, extract the text
-            if isinstance(content, list) and all(hasattr(item, 'text') for item in content):
-                content = '\n'.join(item.text for item in content)
-            
-            # Parse the response content
-            analysis = {}
-            current_process = None
-            description = []
-            
-            for line in content.split('\n'):
-                if line.startswith("Process Name:"):
-                    if current_process:
-                        analysis[current_process]['description'] = ' '.join(description)
-                    current_process = line.split(":")[1].strip()
-                    analysis[current_process] = {}
-                    description = []
-                elif line.startswith("Description:"):
-                    description.append(line.split(":", 1)[1].strip())
-                elif line.startswith("Threat Score:"):
-                    try:
-                        analysis[current_process]['threat_score'] = float(line.split(":")[1].strip())
-                    except ValueError:
-                        analysis[current_process]['threat_score'] = 'N/A'
-                elif line.strip() and current_process:
-                    description.append(line.strip())
-            
-            # Add the last process if exists
-            if current_process:
-                analysis[current_process]['description'] = ' '.join(description)
-            
-            rprint(f"[bold green]✓[/bold green] Parsed {len(analysis)} processes from Anthropic response")
-            return analysis
-        except Exception as e:
-            rprint(f"[bold red]✗[/bold red] Error in Anthropic analysis: {e}")
-            logging.error(f"Error in Anthropic analysis: {e}")
-            logging.debug(f"Response content: {response.content}")
-            return {}
+Respond with a JSON object where each key is the process name and the value is an object containing 'description' and 'threat_score' keys."""
 
-def analyze_processes_ollama(processes_file):
-    ollama_url = os.getenv("OLLAMA_URL", "http://127.0.0.1:11434")
-    ollama_model = os.getenv("OLLAMA_MODEL", "llama3")
-    
-    with open(processes_file, 'r') as f:
-        processes = json.load(f)
-    
-    prompt = f"""You are a Windows security expert. Analyze the following list of Windows processes:
+def _cache_key(process, source):
+    # source is "<provider>:<model>", so one provider's verdicts are never shown as another's
+    return hashlib.sha1(f"{source}\0{process['name']}\0{process['exe']}".encode('utf-8')).hexdigest()
 
-{json.dumps(processes, indent=2)}
+def _is_cacheable(entry):
+    """Only complete verdicts are cached; anything else is re-analyzed on the next run."""
+    return (isinstance(entry, dict)
+            and isinstance(entry.get('description'), str)
+            and isinstance(entry.get('threat_score'), (int, float))
+            and not isinstance(entry.get('threat_score'), bool))
 
-For each process, provide a brief description of its typical function and assign a threat score from 0 (harmless) to 10 (highly suspicious). Consider the process name and path in your analysis. If you're uncertain about a process, state that clearly.
+def _open_cache():
+    conn = sqlite3.connect(AI_CACHE_FILE)
+    conn.execute("CREATE TABLE IF NOT EXISTS analysis (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+    return conn
 
-Respond with a JSON object where each key is the process name and the value is an object containing 'description' and 'threat_score' keys."""
+def load_cached_analysis(processes, source, refresh=False):
+    """Split processes into cached analysis (keyed by name) and those still needing analysis.
 
-    with console.status(f"[bold green]Analyzing processes with Ollama ({ollama_model})..."):
-        try:
-            response = http_session.post(
-                f"{ollama_url}/api/generate",
-                json={
-                    "model": ollama_model,
-                    "prompt": prompt,
-                    "format": "json",
-                    "stream": False
-                },
-                timeout=300  # 5 minutes timeout for processing all processes
-            )
-            response.raise_for_status()
-            result = response.json()
-            
-            if 'response' in result:
-                try:
-                    analysis_text = result['response']
-                    # Try to parse the response as JSON
+    The report holds one verdict per name, so a name counts as cached only when every one of
+    its (name, exe) pairs hits; otherwise all of its rows are re-analyzed together.
+    """
+    if refresh:
+        return {}, list(processes)
+    by_name = {}
+    for process in processes:
+        by_name.setdefault(process['name'], []).append(process)
+    cached = {}
+    misses = []
+    try:
+        with contextlib.closing(_open_cache()) as conn:
+            cutoff = time.time() - AI_CACHE_TTL_DAYS * 86400
+            for name, group in by_name.items():
+                entries = []
+                for process in group:
+                    row = conn.execute("SELECT value FROM analysis WHERE key = ? AND created >= ?",
+                                       (_cache_key(process, source), cutoff)).fetchone()
                     try:
-                        analysis = json.loads(analysis_text)
+                        entry = _json_loads(row[0]) if row else None
                     except json.JSONDecodeError:
-                        # If JSON parsing fails, try to extract information manually
-                        analysis = {}
-                        current_process = None
-                        for line in analysis_text.split('\n'):
-                            if ':' in line:
-                                key, value = line.split(':', 1)
-                                key = key.strip()
-                                value = value.strip()
-                                if key == 'Process Name':
-                                    current_process = value
-                                    analysis[current_process] = {}
-                                elif key == 'Description' and current_process:
-                                    analysis[current_process]['description'] = value
-                                elif key == 'Threat Score' and current_process:
-                                    try:
-                                        analysis[current_process]['threat_score'] = float(value)
-                                    except ValueError:
-                                        analysis[current_process]['threat_score'] = 'N/A'
-                    
-                    rprint(f"[bold green]✓[/bold green] Parsed {len(analysis)} processes from Ollama response")
-                    return analysis
-                except Exception as e:
-                    rprint(f"[bold red]✗[/bold red] Failed to parse Ollama response: {e}")
-                    logging.error(f"Failed to parse Ollama response: {e}")
-                    return {}
-            else:
-                rprint("[bold red]✗[/bold red] Unexpected response format from Ollama")
-                logging.error("Unexpected response format from Ollama")
-                return {}
-        except requests.RequestException as e:
-            rprint(f"[bold red]✗[/bold red] Error in Ollama analysis: {e}")
-            logging.error(f"Error in Ollama analysis: {e}")
-            return {}
-        except Exception as e:
-            rprint(f"[bold red]✗[/bold red] Unexpected error in Ollama analysis: {e}")
-            logging.error(f"Unexpected error in Ollama analysis: {e}")
-            return {}
-
-def analyze_processes_openai(processes_file):
-    client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    model = os.getenv("OPENAI_MODEL", "gpt-4o")
-    
-    with open(processes_file, 'r') as f:
-        processes = json.load(f)
-    
-    prompt = f"""Analyze the following list of Windows processes:
+                        entry = None  # a corrupt row is re-analyzed and overwritten
+                    if not _is_cacheable(entry):
+                        break
+                    entries.append(entry)
+                else:
+                    # Different paths may carry different verdicts; surface the most suspicious one
+                    cached[name] = max(entries, key=lambda entry: entry['threat_score'])
+                    continue
+                misses.extend(group)
+    except sqlite3.Error as e:
+        logging.warning(f"Analysis cache unavailable: {e}")
+        return {}, list(processes)
+    return cached, misses
+
+def store_cached_analysis(processes, analysis, source):
+    now = time.time()
+    rows = [(_cache_key(process, source), _json_dumps(analysis[process['name']]), now)
+            for process in processes if _is_cacheable(analysis.get(process['name']))]
+    try:
+        # closing() releases the connection; the inner "with conn" commits the transaction
+        with contextlib.closing(_open_cache()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO analysis (key, value, created) VALUES (?, ?, ?)", rows)
+    except sqlite3.Error as e:
+        logging.warning(f"Failed to update analysis cache: {e}")
 
-{json.dumps(processes, indent=2)}
+def _to_float(value):
+    try:
+        return float(value.strip())
+    except ValueError:
+        return 'N/A'
 
-For each process, provide a brief description of its typical function and assign a threat score from 0 (harmless) to 10 (highly suspicious). If you're uncertain about a process, state that clearly.
+def _parse_structured(text):
+    """Parse a schema-constrained JSON analysis; malformed output is an error, not prose to salvage."""
+    analysis = _json_loads(text)
+    if not isinstance(analysis, dict):
+        raise ValueError(f"Expected a JSON object, got {type(analysis).__name__}")
+    return analysis
 
-Format your response as follows for each process:
-Process Name: [name]
-Description: [brief description]
-Threat Score: [score]
+def _truncated(label):
+    return ValueError(f"{label} response was cut off at ANALYSIS_MAX_TOKENS={ANALYSIS_MAX_TOKENS}; "
+                      f"lower ANALYSIS_CHUNK_SIZE or raise ANALYSIS_MAX_TOKENS")
 
-Do not include any other text or formatting."""
+def _chunk_processes(processes):
+    """Split into chunks of about ANALYSIS_CHUNK_SIZE rows, keeping every row for a name in one chunk.
 
-    with console.status(f"[bold green]Analyzing processes with OpenAI ({model})..."):
+    The analysis is keyed by name, so this way each verdict covers exactly the paths the model saw together.
+    """
+    by_name = {}
+    for process in processes:
+        by_name.setdefault(process['name'], []).append(process)
+    chunks = []
+    current = []
+    for group in by_name.values():
+        if current and len(current) + len(group) > ANALYSIS_CHUNK_SIZE:
+            chunks.append(current)
+            current = []
+        current.extend(group)
+    if current:
+        chunks.append(current)
+    return chunks
+
+class AnalysisBackend(ABC):
+    """An AI provider. Subclasses set label and model and implement analyze_chunk() for a single request."""
+    label = None
+    model = None
+    # Maximum chunks in flight at once; None sends them all concurrently
+    max_concurrency = None
+
+    @abstractmethod
+    async def analyze_chunk(self, chunk):
+        """Analyze one chunk of processes and return {process name: {description, threat_score}}."""
+
+    async def _analyze_chunk_safely(self, chunk, semaphore):
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=4000,
-                temperature=0
-            )
-            
-            content = response.choices[0].message.content
-            
-            # Parse the response content
-            analysis = {}
-            current_process = None
-            description = []
-            
-            for line in content.split('\n'):
-                if line.startswith("Process Name:"):
-                    if current_process:
-                        analysis[current_process]['description'] = ' '.join(description)
-                    current_process = line.split(":")[1].strip()
-                    analysis[current_process] = {}
-                    description = []
-                elif line.startswith("Description:"):
-                    description.append(line.split(":", 1)[1].strip())
-                elif line.startswith("Threat Score:"):
-                    try:
-                        analysis[current_process]['threat_score'] = float(line.split(":")[1].strip())
-                    except ValueError:
-                        analysis[current_process]['threat_score'] = 'N/A'
-                elif line.strip() and current_process:
-                    description.append(line.strip())
-            
-            # Add the last process if exists
-            if current_process:
-                analysis[current_process]['description'] = ' '.join(description)
-            
-            rprint(f"[bold green]✓[/bold green] Parsed {len(analysis)} processes from OpenAI response")
-            return analysis
+            if semaphore is None:
+                return await self.analyze_chunk(chunk)
+            async with semaphore:
+                return await self.analyze_chunk(chunk)
         except Exception as e:
-            rprint(f"[bold red]✗[/bold red] Error in OpenAI analysis: {e}")
-            logging.error(f"Error in OpenAI analysis: {e}")
+            rprint(f"[bold red]✗[/bold red] Error in {self.label} analysis: {e}")
+            logging.error(f"Error in {self.label} analysis: {e}")
             return {}
 
-def generate_report(processes, analysis):
-    report = """
+    async def analyze(self, processes):
+        """Analyze processes in concurrent chunks and merge the results, keyed by process name."""
+        semaphore = asyncio.Semaphore(self.max_concurrency) if self.max_concurrency else None
+        with console.status(f"[bold green]Analyzing processes with {self.label} ({self.model})..."):
+            results = await asyncio.gather(*(self._analyze_chunk_safely(chunk, semaphore)
+                                             for chunk in _chunk_processes(processes)))
+        analysis = {name: result for chunk_analysis in results for name, result in chunk_analysis.items()}
+        rprint(f"[bold green]✓[/bold green] Parsed {len(analysis)} processes from {self.label} responses")
+        return analysis
+
+class AnthropicBackend(AnalysisBackend):
+    label = "Anthropic"
+
+    def __init__(self):
+        self.model = os.getenv("ANTHROPIC_MODEL", "claude-3-5-sonnet-20240620")
+
+    @functools.cached_property
+    def client(self):
+        return anthropic.AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+
+    async def analyze_chunk(self, chunk):
+        # The static instructions come first and are marked for prompt caching. Anthropic ignores
+        # the marker below its minimum cacheable length (1024 tokens), which the instructions and
+        # tool definition do not reach today; it takes effect only if they grow past it.
+        response = await self.client.messages.create(
+            model=self.model,
+            max_tokens=ANALYSIS_MAX_TOKENS,
+            temperature=0,
+            tools=[ANTHROPIC_ANALYSIS_TOOL],
+            tool_choice={"type": "tool", "name": ANTHROPIC_ANALYSIS_TOOL["name"]},
+            messages=[{
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": PROMPT_INSTRUCTIONS, "cache_control": {"type": "ephemeral"}},
+                    {"type": "text", "text": _prompt_payload(chunk)}
+                ]
+            }]
+        )
+        
+        logging.debug(f"Anthropic response tokens: input={response.usage.input_tokens}, output={response.usage.output_tokens}, "
+                      f"cache_read={getattr(response.usage, 'cache_read_input_tokens', None)}, "
+                      f"cache_write={getattr(response.usage, 'cache_creation_input_tokens', None)}")
+        
+        if response.stop_reason == "max_tokens":
+            raise _truncated(self.label)
+        analysis = next((block.input for block in response.content if block.type == "tool_use"), None)
+        if analysis is None:
+            raise ValueError(f"No tool call in Anthropic response: {response.content}")
+        return analysis
+
+class OpenAIBackend(AnalysisBackend):
+    label = "OpenAI"
+
+    def __init__(self):
+        self.model = os.getenv("OPENAI_MODEL", "gpt-4o")
+
+    @functools.cached_property
+    def client(self):
+        return openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+    async def analyze_chunk(self, chunk):
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": f"{PROMPT_INSTRUCTIONS}\n\n{_prompt_payload(chunk)}"}],
+            max_tokens=ANALYSIS_MAX_TOKENS,
+            temperature=0,
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": "process_analysis", "schema": ANALYSIS_SCHEMA}
+            }
+        )
+        choice = response.choices[0]
+        if choice.finish_reason == "length":
+            raise _truncated(self.label)
+        return _parse_structured(choice.message.content)
+
+class OllamaBackend(AnalysisBackend):
+    label = "Ollama"
+
+    def __init__(self):
+        self.url = os.getenv("OLLAMA_URL", "http://127.0.0.1:11434")
+        self.model = os.getenv("OLLAMA_MODEL", "llama3")
+        # A local Ollama queues requests beyond OLLAMA_NUM_PARALLEL; queued chunks would eat their timeout
+        self.max_concurrency = int(os.getenv("OLLAMA_CONCURRENCY", 1))
+
+    async def analyze_chunk(self, chunk):
+        # requests is blocking; run it in the default executor so chunks overlap
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, functools.partial(
+            http_session.post,
+            f"{self.url}/api/generate",
+            json={
+                "model": self.model,
+                "prompt": f"{PROMPT_INSTRUCTIONS}\n\n{_prompt_payload(chunk)}",
+                "format": ANALYSIS_SCHEMA,
+                "stream": False,
+                "options": {"num_predict": ANALYSIS_MAX_TOKENS}
+            },
+            timeout=300  # 5 minutes timeout per chunk
+        ))
+        response.raise_for_status()
+        result = response.json()
+        if 'response' not in result:
+            raise ValueError("Unexpected response format from Ollama")
+        if result.get('done_reason') == "length":
+            raise _truncated(self.label)
+        return _parse_structured(result['response'])
+
+PROVIDERS = {
+    'anthropic': AnthropicBackend(),
+    'openai': OpenAIBackend(),
+    'ollama': OllamaBackend()
+}
+
+# Upper bounds (exclusive) for each threat score class
+THREAT_CLASSES = ((4, 'threat-low'), (7, 'threat-medium'), (float('inf'), 'threat-high'))
+
+REPORT_HEADER = """
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -312,8 +532,9 @@ def generate_report(processes, analysis):
             }
         </style>
         <script>
+            // The report is rendered sorted by threat score (descending), so the next click sorts ascending
             let sortOrders = {
-                'threat-score': 'desc',
+                'threat-score': 'asc',
                 'name': 'asc',
                 'user': 'asc',
                 'status': 'asc',
@@ -336,8 +557,11 @@ def generate_report(processes, analysis):
                         return aVal < bVal ? 1 : aVal > bVal ? -1 : 0;
                     }
                 });
+                // Reorder inside a fragment so the page reflows once instead of once per process
                 let container = document.querySelector('.process-container');
-                processes.forEach(process => container.appendChild(process));
+                let fragment = document.createDocumentFragment();
+                processes.forEach(process => fragment.appendChild(process));
+                container.appendChild(fragment);
                 sortOrders[key] = sortOrders[key] === 'asc' ? 'desc' : 'asc';
                 updateSortButtons(key);
             }
@@ -349,11 +573,6 @@ def generate_report(processes, analysis):
                     button.style.fontWeight = (key === activeKey) ? 'bold' : 'normal';
                 });
             }
-
-            // Initial sort by threat score
-            window.onload = function() {
-                sortProcesses('threat-score');
-            }
         </script>
     </head>
     <body>
@@ -368,44 +587,23 @@ def generate_report(processes, analysis):
         </div>
         <div class="process-container">
     """
-    
-    for process in processes:
-        process_analysis = analysis.get(process['name'], {})
-        description = process_analysis.get('description', 'No analysis available')
-        threat_score = process_analysis.get('threat_score', 'N/A')
-        
-        try:
-            threat_score_num = float(threat_score)
-            threat_score_display = f"{threat_score_num:.1f}"
-            if threat_score_num < 4:
-                threat_class = 'threat-low'
-            elif threat_score_num < 7:
-                threat_class = 'threat-medium'
-            else:
-                threat_class = 'threat-high'
-        except ValueError:
-            threat_score_num = -1
-            threat_score_display = 'N/A'
-            threat_class = 'threat-low'
-        
-        search_link = f"https://duckduckgo.com/?q={urllib.parse.quote(process['name'])}" if description == 'No analysis available' else ''
-        
-        report += f"""
-        <div class="process" data-name="{process['name']}" data-user="{process['username']}" data-status="{process['status']}" data-threat-score="{threat_score_num}" data-cpu="{process['cpu_percent']}" data-memory="{process['memory_percent']}">
-            <h2>{process['name']} (PID: {process['pid']})</h2>
-            <p><strong>Executable:</strong> {process['exe']}</p>
-            <p><strong>Status:</strong> {process['status']}</p>
-            <p><strong>User:</strong> {process['username']}</p>
-            <p><strong>CPU Usage:</strong> {process['cpu_percent']:.2f}%</p>
-            <p><strong>Memory Usage:</strong> {process['memory_percent']:.2f}%</p>
-            <p><strong>Analysis:</strong> {description.replace('Typical function:', '', 1).strip()}
-            {'<a href="' + search_link + '" target="_blank">Search the web</a>' if search_link else ''}</p>
+
+PROCESS_TEMPLATE = """
+        <div class="process" data-name="{name}" data-user="{username}" data-status="{status}" data-threat-score="{threat_score_num}" data-cpu="{cpu_percent}" data-memory="{memory_percent}">
+            <h2>{name} (PID: {pid})</h2>
+            <p><strong>Executable:</strong> {exe}</p>
+            <p><strong>Status:</strong> {status}</p>
+            <p><strong>User:</strong> {username}</p>
+            <p><strong>CPU Usage:</strong> {cpu_percent:.2f}%</p>
+            <p><strong>Memory Usage:</strong> {memory_percent:.2f}%</p>
+            <p><strong>Analysis:</strong> {description}
+            {search_html}</p>
             <p class="threat-score {threat_class}">Threat Score: {threat_score_display}/10</p>
-            <p><a href="file://{os.path.dirname(process['exe'])}">Open File Location</a></p>
+            <p><a href="file://{exe_dir}">Open File Location</a></p>
         </div>
-        """
-    
-    report += """
+        """.format_map
+
+REPORT_FOOTER = """
         </div>
         <script>
             updateSortButtons('threat-score');
@@ -413,7 +611,53 @@ def generate_report(processes, analysis):
     </body>
     </html>
     """
-    return report
+
+NO_ANALYSIS = 'No analysis available'
+
+def _resolve_analysis(process_analysis):
+    """Return (threat_score_num, threat_score_display, threat_class, description) for one analysis entry."""
+    if not isinstance(process_analysis, dict):
+        process_analysis = {}
+    description = process_analysis.get('description')
+    if not isinstance(description, str):
+        description = NO_ANALYSIS
+    score = process_analysis.get('threat_score')
+    # Some models return the score as a numeric string; _to_float yields 'N/A' for anything unparseable
+    if isinstance(score, str):
+        score = _to_float(score)
+    if isinstance(score, bool) or not isinstance(score, (int, float)) or not math.isfinite(score):
+        return -1, 'N/A', 'threat-low', description
+    score = float(score)
+    threat_class = next(cls for limit, cls in THREAT_CLASSES if score < limit)
+    return score, f"{score:.1f}", threat_class, description
+
+def generate_report(processes, analysis):
+    # Resolve every field up front so the rendering loop is pure substitution
+    rows = [(process, *_resolve_analysis(analysis.get(process['name'], {}))) for process in processes]
+    # Render highest threat first so the page needs no sort on load; unscored processes (-1) go last
+    rows.sort(key=lambda row: -row[1])
+    
+    # Executables and names repeat across processes; resolve each one once (analysis is per name)
+    exe_dirs = {exe: os.path.dirname(exe) for exe in {process['exe'] for process in processes}}
+    search_html = {
+        name: f'<a href="https://duckduckgo.com/?q={urllib.parse.quote(name)}" target="_blank">Search the web</a>'
+        for name in {row[0]['name'] for row in rows if row[4] == NO_ANALYSIS}
+    }
+    
+    parts = [REPORT_HEADER]
+    for process, threat_score_num, threat_score_display, threat_class, description in rows:
+        parts.append(PROCESS_TEMPLATE({
+            **process,
+            'description': description.replace('Typical function:', '', 1).strip(),
+            'search_html': search_html.get(process['name'], ''),
+            'threat_score_num': threat_score_num,
+            'threat_score_display': threat_score_display,
+            'threat_class': threat_class,
+            'exe_dir': exe_dirs[process['exe']]
+        }))
+    
+    parts.append(REPORT_FOOTER)
+    return ''.join(parts)
 
 def save_report(report):
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M")
@@ -426,7 +670,7 @@ def save_report(report):
     logging.info(f"Report saved as {filename}")
     return filename
 
-def main(ai_provider):
+def main(ai_provider, refresh=False, save_processes=False, pretty=False):
     try:
         rprint(Panel(f"[bold blue]Starting AI Process Report with {ai_provider.upper()}[/bold blue]"))
         
@@ -434,18 +678,34 @@ def main(ai_provider):
             processes = get_processes()
             status.update(f"[bold green]Retrieved {len(processes)} processes (limit: {PROCESS_LIMIT})")
         
-        processes_file = save_processes_to_file(processes)
-        rprint(f"[bold green]✓[/bold green] Saved processes to {processes_file}")
+        if save_processes:
+            try:
+                processes_file = save_processes_to_file(processes, pretty)
+                rprint(f"[bold green]✓[/bold green] Saved processes to {processes_file}")
+            except OSError as e:
+                logging.warning(f"Failed to save processes to file: {e}")
         
-        if ai_provider == 'ollama':
-            analysis = analyze_processes_ollama(processes_file)
-        elif ai_provider == 'anthropic':
-            analysis = analyze_processes_anthropic(processes_file)
-        elif ai_provider == 'openai':
-            analysis = analyze_processes_openai(processes_file)
-        else:
+        if ai_provider not in PROVIDERS:
             rprint(f"[bold red]✗[/bold red] Unsupported AI provider: {ai_provider}")
             return
+        backend = PROVIDERS[ai_provider]
+        cache_source = f"{ai_provider}:{backend.model}"
+        
+        analysis, misses = load_cached_analysis(processes, cache_source, refresh)
+        if analysis:
+            rprint(f"[bold green]✓[/bold green] Loaded {len(analysis)} cached analyses, {len(misses)} processes need analysis")
+        
+        if misses:
+            # Repeated (name, exe) pairs only need one request row; distinct paths for a name are all sent
+            unique = list({(process['name'], process['exe']): process for process in misses}.values())
+            logging.info(f"Deduplicated {len(misses)} processes to {len(unique)} for analysis "
+                         f"({len(misses) / len(unique):.1f}x compression)")
+            rprint(f"[bold green]✓[/bold green] Sending {len(unique)} unique processes (of {len(misses)}) for analysis")
+            fresh = asyncio.run(backend.analyze(unique))
+            
+            # Every (name, exe) in unique was sent in the same chunk as the rest of its name's rows
+            store_cached_analysis(unique, fresh, cache_source)
+            analysis.update(fresh)
         
         rprint(f"[bold green]✓[/bold green] Analysis completed. Number of analyzed processes: {len(analysis)}")
         
@@ -467,14 +727,17 @@ def main(ai_provider):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="AI Process Report")
-    parser.add_argument('--ai', choices=['anthropic', 'openai', 'ollama'], 
+    parser.add_argument('--ai', choices=list(PROVIDERS), 
                         default=AI_PROVIDER, 
                         help="Choose the AI model to use (overrides .env setting)")
     parser.add_argument('--debug', action='store_true', help="Enable debug mode")
+    parser.add_argument('--refresh', action='store_true', help="Ignore cached analyses and re-analyze every process")
+    parser.add_argument('--save-processes', action='store_true', help="Also save the gathered processes to a JSON file")
+    parser.add_argument('--pretty', action='store_true', help="Indent the JSON written by --save-processes")
     args = parser.parse_args()
 
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
         logging.debug("Debug mode enabled")
 
-    main(args.ai)
\ No newline at end of file
+    main(args.ai, args.refresh, args.save_processes, args.pretty)
\ No newline at end of file